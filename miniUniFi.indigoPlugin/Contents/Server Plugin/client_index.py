@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import bisect
+
+# Secondary indexes over the active clients of one site, so lookups by IP, name, AP, etc. don't have to
+# walk the whole 'actives' dict.  Updated incrementally from each new 'actives' snapshot, which also gives
+# the list of clients that joined, left, roamed or changed radio since the previous snapshot.
+
+def indexKeys(data):
+    names = []
+    for field in ('name', 'hostname'):
+        if (name := data.get(field)) and name.lower() not in names:
+            names.append(name.lower())
+    vlan = data.get('vlan')
+    return {
+        'ip': data.get('ip'),
+        'ap_mac': data.get('ap_mac'),
+        'essid': data.get('essid'),
+        'vlan': str(vlan) if vlan is not None else None,
+        'names': tuple(names),
+    }
+
+
+def presenceKeys(data):
+    return data.get('ap_mac'), data.get('essid'), data.get('radio'), data.get('channel')
+
+def clientEvent(event, mac, old_data, new_data):
+    old_ap, old_essid, old_radio, old_channel = presenceKeys(old_data) if old_data else (None, None, None, None)
+    new_ap, new_essid, new_radio, new_channel = presenceKeys(new_data) if new_data else (None, None, None, None)
+    data = new_data or old_data or {}
+    return {
+        'event': event, 'mac': mac,
+        'name': data.get('name') or data.get('hostname') or mac,
+        'old_ap_mac': old_ap, 'new_ap_mac': new_ap,
+        'old_essid': old_essid, 'new_essid': new_essid,
+        'old_radio': old_radio, 'new_radio': new_radio,
+        'old_channel': old_channel, 'new_channel': new_channel,
+    }
+
+
+class SiteIndex(object):
+
+    def __init__(self):
+        self.by_mac = {}    # client data keyed by MAC
+        self.keys = {}      # indexed values keyed by MAC, used to detect changes
+        self.by_ip = {}     # sets of MACs keyed by IP address
+        self.by_ap = {}     # sets of MACs keyed by AP MAC
+        self.by_essid = {}  # sets of MACs keyed by ESSID
+        self.by_vlan = {}   # sets of MACs keyed by VLAN (as a string)
+        self.names = []     # sorted list of (lower case name, MAC) tuples
+        self.presence = {}  # (AP MAC, ESSID, radio, channel) keyed by MAC
+        self.departed = {}  # (missed snapshots, last client data) keyed by MAC, for clients not yet reported as left
+        self.primed = False # no events for the first snapshot, everything would look like it just joined
+
+    def update(self, actives, leave_after=1):
+        # returns a list of client event dicts (see clientEvent).  A client has to be missing from leave_after
+        # snapshots in a row before it's reported as left, the same hysteresis as the device onOffState.
+        events = []
+
+        # drop clients that are no longer active from the indexes, but hold on to them until they've really left
+        for mac in [mac for mac in self.by_mac if mac not in actives]:
+            self.departed[mac] = (0, self.by_mac[mac])
+            self._remove(mac)
+            del self.by_mac[mac]
+        for mac in [mac for mac in self.departed if mac not in actives]:
+            missed, data = self.departed[mac]
+            if missed + 1 >= leave_after:
+                events.append(clientEvent('client_left', mac, data, None))
+                del self.departed[mac]
+                del self.presence[mac]
+            else:
+                self.departed[mac] = (missed + 1, data)
+
+        for mac, data in actives.items():
+            old_data = self.by_mac.get(mac)
+            if old_data is None and mac in self.departed:
+                old_data = self.departed.pop(mac)[1]    # back before it was reported as left
+            self.by_mac[mac] = data
+
+            presence = presenceKeys(data)
+            old_presence = self.presence.get(mac)
+            self.presence[mac] = presence
+            if old_presence is None:
+                events.append(clientEvent('client_joined', mac, None, data))
+            elif presence[:2] != old_presence[:2]:
+                events.append(clientEvent('client_roamed', mac, old_data, data))
+            elif presence[2:] != old_presence[2:]:
+                events.append(clientEvent('client_radio_changed', mac, old_data, data))
+
+            keys = indexKeys(data)
+            old_keys = self.keys.get(mac)
+            if keys == old_keys:
+                continue
+            if old_keys:
+                self._remove(mac)
+            self._add(mac, keys)
+
+        if not self.primed:
+            self.primed = True
+            return []
+        return events
+
+    def _add(self, mac, keys):
+        self.keys[mac] = keys
+        for index, field in ((self.by_ip, 'ip'), (self.by_ap, 'ap_mac'), (self.by_essid, 'essid'), (self.by_vlan, 'vlan')):
+            if keys[field] is not None:
+                index.setdefault(keys[field], set()).add(mac)
+        for name in keys['names']:
+            bisect.insort(self.names, (name, mac))
+
+    def _remove(self, mac):
+        keys = self.keys.pop(mac, None)
+        if not keys:
+            return
+        for index, field in ((self.by_ip, 'ip'), (self.by_ap, 'ap_mac'), (self.by_essid, 'essid'), (self.by_vlan, 'vlan')):
+            macs = index.get(keys[field])
+            if macs is not None:
+                macs.discard(mac)
+                if not macs:
+                    del index[keys[field]]
+        for name in keys['names']:
+            i = bisect.bisect_left(self.names, (name, mac))
+            if i < len(self.names) and self.names[i] == (name, mac):
+                del self.names[i]
+
+    ########################################
+    # lookups, all return a list of client data dicts
+    ########################################
+
+    def find(self, index, value):
+        if index == 'mac':
+            data = self.by_mac.get(value.lower())
+            return [data] if data else []
+        elif index == 'ip':
+            macs = self.by_ip.get(value, ())
+        elif index == 'ap_mac':
+            macs = self.by_ap.get(value.lower(), ())
+        elif index == 'essid':
+            macs = self.by_essid.get(value, ())
+        elif index == 'vlan':
+            macs = self.by_vlan.get(str(value), ())
+        elif index == 'name':
+            macs = self.prefix(value)
+        else:
+            raise ValueError(f"unknown index: {index}")
+        return [self.by_mac[mac] for mac in sorted(macs)]
+
+    def prefix(self, prefix):
+        prefix = prefix.lower()
+        macs = []
+        i = bisect.bisect_left(self.names, (prefix,))
+        while i < len(self.names) and self.names[i][0].startswith(prefix):
+            if self.names[i][1] not in macs:
+                macs.append(self.names[i][1])
+            i += 1
+        return macs
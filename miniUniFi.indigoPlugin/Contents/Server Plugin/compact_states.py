@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import sys
+
+# Compact storage for the flattened states of a device.  Devices of the same model (and clients of the same kind)
+# end up with identical sets of state keys, so the key tuple is interned and shared between them, and each
+# device only keeps a tuple of its values.
+
+MAX_SHAPES = 10000      # forget the interned shapes if there get to be this many, devices keep the ones they have
+
+_shapes = {}
+
+def shape(keys):
+    keys = tuple(keys)
+    interned = _shapes.get(keys)
+    if interned is None:
+        if len(_shapes) >= MAX_SHAPES:
+            _shapes.clear()
+        interned = tuple(sys.intern(key) for key in keys)
+        _shapes[interned] = interned
+    return interned
+
+
+class CompactStates(object):
+    __slots__ = ('keys', 'values')
+
+    def __init__(self, states_list):
+        self.keys = shape(item['key'] for item in states_list)
+        self.values = tuple(item['value'] for item in states_list)
+
+    def __iter__(self):
+        return zip(self.keys, self.values)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key, default=None):
+        try:
+            return self.values[self.keys.index(key)]
+        except ValueError:
+            return default
+
+    def states_list(self):
+        return [{'key': key, 'value': value} for key, value in zip(self.keys, self.values)]
+
+    def same_shape(self, other):
+        # same keys with the same value types, so the device's state list doesn't need to be rebuilt
+        if other is None or other.keys is not self.keys:
+            return False
+        return all(type(a) is type(b) for a, b in zip(self.values, other.values))
@@ -0,0 +1,183 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import json
+
+from array import array
+
+# Filtering for the flattened states from dict_to_states, so values that change on every poll (signal levels,
+# counters, uptimes) don't get written to the server (and the SQL Logger) every time.
+#
+# Rules are per device type, keyed by state name.  A rule name also matches any state that ends with "_<name>",
+# so "tx_bytes" covers "uplink_tx_bytes" and "port_table_3_tx_bytes".  Rule options:
+#
+#   abs         only publish if the value changed by at least this much
+#   pct         only publish if the value changed by at least this percent of the last published value
+#   interval    don't republish more often than this (seconds)
+#   never       never publish (for monotonic counters)
+
+COUNTERS = ['bytes', 'tx_bytes', 'rx_bytes', 'tx_packets', 'rx_packets', 'tx_dropped', 'rx_dropped', 'tx_errors',
+            'rx_errors', 'tx_retries', 'wifi_tx_attempts', 'tx_multicast', 'rx_multicast', 'tx_broadcast',
+            'rx_broadcast', 'wired-tx_bytes', 'wired-rx_bytes', 'wired-tx_packets', 'wired-rx_packets']
+
+RATES = ['bytes-r', 'tx_bytes-r', 'rx_bytes-r', 'wired-tx_bytes-r', 'wired-rx_bytes-r']
+
+CLIENT_RULES = {
+    **{name: {'never': True} for name in COUNTERS},
+    **{name: {'pct': 25, 'interval': 300} for name in RATES},
+    'signal': {'abs': 5},
+    'rssi': {'abs': 5},
+    'noise': {'abs': 5},
+    'satisfaction': {'abs': 10},
+    'tx_rate': {'pct': 20},
+    'rx_rate': {'pct': 20},
+    'uptime': {'interval': 900},
+    'idletime': {'interval': 900},
+    'last_seen': {'interval': 300},
+}
+
+DEVICE_RULES = {
+    **{name: {'never': True} for name in COUNTERS},
+    **{name: {'pct': 25, 'interval': 300} for name in RATES},
+    'satisfaction': {'abs': 10},
+    'cpu': {'abs': 5},
+    'mem': {'abs': 5},
+    'loadavg_1': {'abs': 0.5},
+    'loadavg_5': {'abs': 0.5},
+    'loadavg_15': {'abs': 0.5},
+    'uptime': {'interval': 900},
+    'last_seen': {'interval': 300},
+}
+
+DEADBAND_DEFAULTS = {
+    'unifiClient': CLIENT_RULES,
+    'unifiWirelessClient': CLIENT_RULES,
+    'unifiDevice': DEVICE_RULES,
+    'unifiAccessPoint': DEVICE_RULES,
+}
+
+def deadband_rules(overrides):
+    # overrides is a JSON string in the same form as DEADBAND_DEFAULTS, merged over the defaults.
+    # Raises ValueError if it's not valid.
+    rules = {typeId: dict(type_rules) for typeId, type_rules in DEADBAND_DEFAULTS.items()}
+    if not overrides or not overrides.strip():
+        return rules
+    try:
+        overrides = json.loads(overrides)
+    except json.JSONDecodeError as err:
+        raise ValueError(f"invalid JSON: {err}")
+    if not isinstance(overrides, dict):
+        raise ValueError("must be a JSON object keyed by device type")
+    for typeId, type_rules in overrides.items():
+        if not isinstance(type_rules, dict) or not all(isinstance(rule, dict) for rule in type_rules.values()):
+            raise ValueError(f"rules for {typeId} must be an object of state name: rule object")
+        rules.setdefault(typeId, {}).update(type_rules)
+    return rules
+
+def as_number(value):
+    # the controller reports some numbers as strings (system-stats cpu and mem, sys_stats loadavg)
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+MISSING = object()      # never published (or dropped from the device's state list since)
+
+
+class Published(object):
+    # the last published value and time of each state, lined up with the device's shared key tuple (see
+    # compact_states.py), so the filter doesn't keep another per-device key -> value dict
+    __slots__ = ('keys', 'values', 'times')
+
+    def __init__(self, states, previous=None):
+        # states the device still has with the same type keep their last published value, the others come
+        # back empty after the state list is rebuilt, so they're published again
+        self.keys = states.keys
+        self.values = [MISSING] * len(states)
+        self.times = array('d', bytes(8 * len(states)))
+        if previous is not None:
+            index = {key: i for i, key in enumerate(previous.keys)}
+            for i, (key, value) in enumerate(states):
+                j = index.get(key)
+                if j is not None and type(previous.values[j]) is type(value):
+                    self.values[i] = previous.values[j]
+                    self.times[i] = previous.times[j]
+
+
+class DeadbandFilter(object):
+
+    def __init__(self, rules, enabled=True):
+        self.rules = rules
+        self.enabled = enabled
+        self.resolved = {}      # rule (or None) for each state key, keyed by device type
+        self.published = {}     # Published values and times, keyed by DeviceID
+        self.latest = {}        # latest CompactStates (published or not), keyed by DeviceID
+
+    def forget(self, device_id):
+        self.published.pop(device_id, None)
+        self.latest.pop(device_id, None)
+
+    def rule(self, typeId, key):
+        cache = self.resolved.setdefault(typeId, {})
+        if key not in cache:
+            type_rules = self.rules.get(typeId, {})
+            rule = type_rules.get(key)
+            if rule is None:
+                matches = [name for name in type_rules if key.endswith(f"_{name}")]
+                if matches:
+                    rule = type_rules[max(matches, key=len)]
+            cache[key] = rule
+        return cache[key]
+
+    def never(self, typeId, key):
+        # states that are never published are left out of the device's state list, rather than sitting there empty
+        rule = self.rule(typeId, key) if self.enabled else None
+        return bool(rule and rule.get('never'))
+
+    def filter(self, device_id, typeId, states, now):
+        # returns a states list of the part of states (a CompactStates) that should be sent to the server
+        previous = self.latest.get(device_id)
+        self.latest[device_id] = states
+        if not self.enabled:
+            return states.states_list()
+
+        published = self.published.get(device_id)
+        if published is None or published.keys is not states.keys or not states.same_shape(previous):
+            published = self.published[device_id] = Published(states, published)
+        values, times = published.values, published.times
+        publish = []
+        for i, (key, value) in enumerate(states):
+            last_value = values[i]
+            if last_value is not MISSING and last_value == value:
+                continue
+            rule = self.rule(typeId, key)
+            if rule:
+                if rule.get('never'):
+                    continue
+                if last_value is not MISSING and not self.significant(rule, last_value, times[i], value, now):
+                    continue
+            values[i] = value
+            times[i] = now
+            publish.append({'key': key, 'value': value})
+        return publish
+
+    @staticmethod
+    def significant(rule, last_value, last_time, value, now):
+        if now - last_time < rule.get('interval', 0):
+            return False
+        value = as_number(value)
+        last_value = as_number(last_value)
+        if value is not None and last_value is not None:
+            change = abs(value - last_value)
+            if change < rule.get('abs', 0):
+                return False
+            if 'pct' in rule and last_value and (change * 100.0 / abs(last_value)) < rule['pct']:
+                return False
+        return True
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import time
+import socket
+import threading
+
+# A controller can be reachable at several addresses (LAN IP, hostname, VPN address).  Each one is probed in
+# the background with a TCP connect to measure round trip time, and requests go to the fastest healthy one.
+
+LATENCY_SMOOTHING = 0.3     # weight of the newest probe in the moving average
+SWITCH_MARGIN = 0.8         # only switch to another endpoint if it's at least 20% faster than the current one
+
+def parseAddress(address, default_port):
+    # "host", "host:port", "[v6 address]" or "[v6 address]:port"
+    address = address.strip()
+    if address.startswith('['):
+        host, _, rest = address[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else ""
+        host = f"[{host}]"
+    elif address.count(':') == 1:
+        host, _, port = address.partition(':')
+    else:
+        host, port = address, ""
+    if port.isdigit():
+        return host, int(port), True
+    return host, int(default_port), False
+
+
+class Endpoint(object):
+
+    def __init__(self, address, default_port):
+        self.host, self.port, self.explicit_port = parseAddress(address, default_port)
+        self.latency = None     # smoothed TCP connect time, seconds
+        self.healthy = True     # until proven otherwise
+        self.last_error = None
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+    def url(self, path, with_port=True):
+        if with_port or self.explicit_port:
+            return f"https://{self.host}:{self.port}{path}"
+        return f"https://{self.host}{path}"
+
+    def probe(self, timeout=2.0):
+        start = time.time()
+        try:
+            with socket.create_connection((self.host.strip('[]'), self.port), timeout=timeout):
+                pass
+        except OSError as err:
+            self.failed(err)
+            return
+        self.succeeded(time.time() - start)
+
+    def succeeded(self, latency=None):
+        self.healthy = True
+        self.last_error = None
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = LATENCY_SMOOTHING * latency + (1.0 - LATENCY_SMOOTHING) * self.latency
+
+    def failed(self, err):
+        self.healthy = False
+        self.last_error = str(err)
+
+
+class EndpointSet(object):
+
+    def __init__(self, addresses, default_port):
+        self.endpoints = [Endpoint(address, default_port) for address in addresses if address.strip()]
+        self.current = self.endpoints[0] if self.endpoints else None
+        self.lock = threading.Lock()
+
+    def probe(self):
+        for endpoint in self.endpoints:
+            endpoint.probe()
+        self.select()
+
+    def select(self):
+        # stay with the current endpoint unless it's unhealthy or another one is clearly faster
+        with self.lock:
+            healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+            if not healthy:
+                return self.current
+            fastest = min(healthy, key=lambda e: e.latency if e.latency is not None else float('inf'))
+            current = self.current
+            if current is None or not current.healthy or current.latency is None:
+                self.current = fastest if fastest.latency is not None else healthy[0]
+            elif fastest.latency is not None and fastest.latency < current.latency * SWITCH_MARGIN:
+                self.current = fastest
+            return self.current
+
+    def ordered(self):
+        # the endpoints to try, in order: the selected one, other healthy ones, then the unhealthy ones
+        current = self.select()
+        rest = [endpoint for endpoint in self.endpoints if endpoint is not current]
+        rest.sort(key=lambda e: (not e.healthy, e.latency if e.latency is not None else float('inf')))
+        return ([current] if current else []) + rest
+
+    def failed(self, endpoint, err):
+        endpoint.failed(err)
+        self.select()
+
+    def succeeded(self, endpoint):
+        if not endpoint.healthy:
+            endpoint.succeeded()
+        with self.lock:
+            self.current = endpoint
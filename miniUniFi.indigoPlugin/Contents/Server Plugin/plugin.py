@@ -2,15 +2,28 @@
 # -*- coding: utf-8 -*-
 ####################
 
+import os
 import time
+import threading
 import requests
 import logging
 import json
 
+from contextlib import contextmanager
 from datetime import datetime
 
+from client_index import SiteIndex
+from compact_states import CompactStates
+from deadband import DeadbandFilter, deadband_rules
+from endpoints import EndpointSet
+from traffic_capture import TrafficRecorder
+
 requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
+REFRESH_DELAY = 2.0     # seconds to wait for more devices to start before doing a refresh
+REFRESH_MAX_DELAY = 10.0    # but don't keep putting it off forever
+PROBE_INTERVAL = 30.0   # seconds between background latency checks of controller endpoints
+
 
 # Indigo really doesn't like dicts with keys that start with a number or symbol...
 
@@ -58,6 +71,22 @@ def nameFromClient(data):
 def nameFromDevice(data):
     return data.get('name', f"{data.get('model')} @ {data.get('ip')}")
 
+# summary of a client for returning to scripts, Indigo can't handle None values or nested dicts with odd keys
+
+def summaryFromClient(controllerID, site, data):
+    return {
+        'controller': controllerID,
+        'site': site,
+        'mac': data.get('mac', ''),
+        'ip': data.get('ip', ''),
+        'name': nameFromClient(data),
+        'hostname': data.get('hostname', ''),
+        'is_wired': data.get('is_wired', False),
+        'ap_mac': data.get('ap_mac', ''),
+        'essid': data.get('essid', ''),
+        'vlan': str(data.get('vlan', '')),
+    }
+
 ################################################################################
 class Plugin(indigo.PluginBase):
 
@@ -80,52 +109,166 @@ class Plugin(indigo.PluginBase):
             self.updateFrequency = 30.0
         self.logger.debug(f"updateFrequency = {self.updateFrequency}")
         self.next_update = time.time()
+        self.clock = time.time  # time source for snapshot ages, deadbands and offline timing; replay.py drives it
+
+        self.offlineMissedPolls = int(pluginPrefs.get('offlineMissedPolls', "2"))
+        try:
+            rules = deadband_rules(pluginPrefs.get('deadbandOverrides', ""))
+        except ValueError as err:
+            self.logger.warning(f"Ignoring deadband overrides: {err}")
+            rules = deadband_rules("")
+        self.deadband = DeadbandFilter(rules, pluginPrefs.get('deadbandEnabled', True))
+        self.missed_polls = {}  # (count, site update time) keyed by DeviceID, for offline hysteresis
 
         self.unifi_controllers = {}  # dict of controller info dicts keyed by DeviceID.
-        self.unifi_clients = {}  # dict of device state definitions keyed by DeviceID.
-        self.unifi_devices = {}  # dict of device state definitions keyed by DeviceID.
-        self.update_needed = False
+        self.unifi_clients = {}  # dict of device state definitions (CompactStates) keyed by DeviceID.
+        self.unifi_devices = {}  # dict of device state definitions (CompactStates) keyed by DeviceID.
+        self.client_indexes = {}  # dict of SiteIndex objects keyed by (controller DeviceID, site name)
+        self.recorders = {}  # dict of TrafficRecorder objects keyed by controller DeviceID, only when capturing
+        self.endpoints = {}  # dict of EndpointSet objects keyed by controller DeviceID
+        self.probe_stop = threading.Event()
+        self.probe_thread = None
+        self.triggers = {}  # dict of client event triggers keyed by TriggerID
+        self.last_client_events = {}  # dict of the most recent client event keyed by client MAC
+        self.last_client_event = None
+        self.refresh_lock = threading.Lock()
+        self.refresh_requests = {}  # dict of sets of site names (or None for all sites) keyed by controller DeviceID
+        self.refresh_first = None
+        self.refresh_after = None
         self.last_controller = None
         self.last_site = 'default'
 
     def startup(self):
         self.logger.info("Starting miniUniFi")
+        self.probe_thread = threading.Thread(target=self.probe_endpoints, name="probe_endpoints", daemon=True)
+        self.probe_thread.start()
 
     def shutdown(self):
         self.logger.info("Shutting down miniUniFi")
+        self.probe_stop.set()
+        for recorder in list(self.recorders.values()):
+            recorder.close()
+
+    def probe_endpoints(self):
+        # measure round trip time to each controller address, so requests go to the fastest one
+        while not self.probe_stop.is_set():
+            for controllerID, endpoint_set in list(self.endpoints.items()):
+                if len(endpoint_set.endpoints) < 2:
+                    continue
+                endpoint_set.probe()
+                for endpoint in endpoint_set.endpoints:
+                    latency = f"{endpoint.latency * 1000.0:.1f} ms" if endpoint.latency is not None else "unknown"
+                    self.logger.threaddebug(f"Controller {controllerID} endpoint {endpoint}: healthy = {endpoint.healthy}, latency = {latency}")
+            self.probe_stop.wait(PROBE_INTERVAL)
 
     def runConcurrentThread(self):
         self.logger.debug("Starting runConcurrentThread")
         try:
             while True:
-                if (time.time() > self.next_update) or self.update_needed:
+                if time.time() > self.next_update:
                     self.next_update = time.time() + self.updateFrequency
-                    self.update_needed = False
 
-                    # update from UniFi Controllers
+                    # update from UniFi Controllers, then all the client and UniFi devices
 
                     for controllerID in list(self.unifi_controllers):
                         self.updateUniFiController(indigo.devices[controllerID])
+                    self.updateDevices()
+
+                elif self.refresh_after and time.time() > self.refresh_after:
+                    with self.refresh_lock:
+                        refresh_requests = self.refresh_requests
+                        self.refresh_requests = {}
+                        self.refresh_first = self.refresh_after = None
+
+                    # only poll the controllers and sites that were asked for, then the devices on them.
+                    # Sites polled since the request was made (by a full poll in progress) use the cached data.
+
+                    for controllerID, sites in refresh_requests.items():
+                        if controllerID not in self.unifi_controllers:
+                            continue
+                        if sites is None:
+                            known = self.unifi_controllers[controllerID].get('sites') or {}
+                            if known and all(self.site_is_fresh(controllerID, site) for site in known):
+                                continue
+                        else:
+                            sites = {site for site in sites if not self.site_is_fresh(controllerID, site)}
+                            if not sites:
+                                continue
+                        self.logger.debug(f"Refreshing controller {controllerID}, sites: {sites if sites else 'all'}")
+                        self.updateUniFiController(indigo.devices[controllerID], sites)
+                    self.updateDevices(refresh_requests)
 
-                    # now update all the client devices  
+                self.sleep(0.5)
 
-                    for clientID in list(self.unifi_clients):
-                        self.updateUniFiClient(indigo.devices[clientID])
+        except self.StopThread:
+            pass
 
-                    # now update all the UniFi devices  
+    def request_refresh(self, controllerID, site=None):
+        # collect refresh requests for a short time, so starting lots of devices only causes one poll
+        with self.refresh_lock:
+            if site is None:
+                self.refresh_requests[controllerID] = None
+            elif self.refresh_requests.get(controllerID, set()) is not None:
+                self.refresh_requests.setdefault(controllerID, set()).add(site)
+            now = time.time()
+            if not self.refresh_first:
+                self.refresh_first = now
+            self.refresh_after = min(now + REFRESH_DELAY, self.refresh_first + REFRESH_MAX_DELAY)
+
+    def site_is_fresh(self, controllerID, site):
+        try:
+            updated = self.unifi_controllers[controllerID]['sites'][site]['updated']
+        except (Exception,):
+            return False
+        return (self.clock() - updated) < self.updateFrequency
 
-                    for deviceID in list(self.unifi_devices):
-                        try:
-                            unifiDevice = indigo.devices[deviceID]
-                        except Exception as err:
-                            self.logger.error(f"Error retrieving Device ID {deviceID}: {err}")
-                        else:
-                            self.updateUniFiDevice(unifiDevice)
+    def updateDevices(self, refreshed=None):
+        # update the client and UniFi devices, limited to the controllers and sites in refreshed if specified
 
-                self.sleep(1.0)
+        def wanted(device):
+            if refreshed is None:
+                return True
+            try:
+                controllerID = int(device.pluginProps['unifi_controller'])
+            except (Exception,):
+                return False
+            if controllerID not in refreshed:
+                return False
+            return refreshed[controllerID] is None or device.pluginProps.get('unifi_site') in refreshed[controllerID]
 
-        except self.StopThread:
-            pass
+        for clientID in list(self.unifi_clients):
+            try:
+                unifiClient = indigo.devices[clientID]
+            except Exception as err:
+                self.logger.error(f"Error retrieving Device ID {clientID}: {err}")
+            else:
+                if wanted(unifiClient):
+                    self.updateUniFiClient(unifiClient)
+
+        for deviceID in list(self.unifi_devices):
+            try:
+                unifiDevice = indigo.devices[deviceID]
+            except Exception as err:
+                self.logger.error(f"Error retrieving Device ID {deviceID}: {err}")
+            else:
+                if wanted(unifiDevice):
+                    self.updateUniFiDevice(unifiDevice)
+
+    def refresh_or_update(self, device):
+        # use the cached site data if it's recent enough, otherwise ask for that site to be polled
+        try:
+            controllerID = int(device.pluginProps['unifi_controller'])
+            site = device.pluginProps['unifi_site']
+        except (Exception,):
+            self.logger.debug(f"{device.name}: no controller or site configured")
+            return
+
+        if not self.site_is_fresh(controllerID, site):
+            self.request_refresh(controllerID, site)
+        elif device.deviceTypeId in ['unifiClient', 'unifiWirelessClient']:
+            self.updateUniFiClient(device)
+        else:
+            self.updateUniFiDevice(device)
 
     def deviceStartComm(self, device):
 
@@ -138,17 +281,26 @@ class Plugin(indigo.PluginBase):
 
         if device.deviceTypeId == 'unifiController':
             self.unifi_controllers[device.id] = {'name': device.name}  # all the associated data added during update
-            self.update_needed = True
+            self.endpoints[device.id] = self.endpoint_set(device)
+            if device.pluginProps.get('capture_traffic', False):
+                path = os.path.join(self.capture_folder(), f"capture-{device.id}.jsonl.gz")
+                self.logger.info(f"{device.name}: Capturing controller traffic to {path}")
+                self.recorders[device.id] = TrafficRecorder(path)
+            self.request_refresh(device.id)
             if not self.last_controller:
                 self.last_controller = str(device.id)
 
         elif device.deviceTypeId in ['unifiClient', 'unifiWirelessClient']:
             self.unifi_clients[device.id] = None  # discovered states for the device
-            self.update_needed = True
+            self.deadband.forget(device.id)
+            self.missed_polls.pop(device.id, None)
+            self.refresh_or_update(device)
 
         elif device.deviceTypeId in ['unifiDevice', 'unifiAccessPoint']:
             self.unifi_devices[device.id] = None  # discovered states for the device
-            self.update_needed = True
+            self.deadband.forget(device.id)
+            self.missed_polls.pop(device.id, None)
+            self.refresh_or_update(device)
 
         device.stateListOrDisplayStateIdChanged()
 
@@ -158,11 +310,16 @@ class Plugin(indigo.PluginBase):
 
         if device.deviceTypeId == 'unifiController':
             del self.unifi_controllers[device.id]
+            for key in [key for key in self.client_indexes if key[0] == device.id]:
+                del self.client_indexes[key]
+            if recorder := self.recorders.pop(device.id, None):
+                recorder.close()
+            self.endpoints.pop(device.id, None)
 
         elif device.deviceTypeId in ['unifiClient', 'unifiWirelessClient']:
             del self.unifi_clients[device.id]
 
-        elif device.deviceTypeId == 'unifiDevice':
+        elif device.deviceTypeId in ['unifiDevice', 'unifiAccessPoint']:
             del self.unifi_devices[device.id]
 
     ########################################
@@ -171,6 +328,73 @@ class Plugin(indigo.PluginBase):
     #
     ########################################
 
+    def capture_folder(self):
+        return os.path.join(indigo.server.getInstallFolderPath(), "Logs", self.pluginId, "capture")
+
+    @contextmanager
+    def capture_cycle(self, controller, op):
+        recorder = self.recorders.get(controller.id)
+        if recorder:
+            recorder.begin_cycle(op, controller.name)
+        try:
+            yield
+        finally:
+            if recorder:
+                recorder.end_cycle()
+
+    @staticmethod
+    def endpoint_set(controller):
+        addresses = [controller.pluginProps['address']] + controller.pluginProps.get('alt_addresses', "").split(',')
+        return EndpointSet(addresses, controller.pluginProps.get('port', "8443"))
+
+    @staticmethod
+    def never_connected(err):
+        # True if the request can't have reached the controller, so it's safe to send it again somewhere else
+        if isinstance(err, requests.ConnectTimeout):
+            return True
+        reason = getattr(err.args[0], 'reason', None) if err.args else None
+        return isinstance(reason, requests.packages.urllib3.exceptions.NewConnectionError)
+
+    def controller_request(self, controller, session, op, method, path, with_port=True, idempotent=True, **kwargs):
+        # all controller traffic goes through here, so it can be captured (and replaced by replay.py).
+        # Tries the controller's endpoints in order of preference, moving on to the next only if it can't connect.
+        # A read timeout means the controller got the request, so that's never retried.  Nor is a non-idempotent
+        # request (a device command) unless it certainly never got there.
+        # Cookies are passed explicitly by the callers, so the login session still works on another endpoint.
+
+        recorder = self.recorders.get(controller.id)
+        endpoint_set = self.endpoints.get(controller.id) or self.endpoint_set(controller)
+        last_error = None
+        for endpoint in endpoint_set.ordered():
+            url = endpoint.url(path, with_port)
+            start = time.time()
+            try:
+                if session:
+                    response = session.request(method, url, **kwargs)
+                else:
+                    response = requests.request(method, url, **kwargs)
+            except requests.ConnectionError as err:
+                if recorder:
+                    recorder.record(op, method, url, kwargs, None, time.time() - start, err)
+                self.logger.warning(f"{controller.name}: unable to reach {endpoint}: {err}")
+                endpoint_set.failed(endpoint, err)
+                if not idempotent and not self.never_connected(err):
+                    raise
+                last_error = err
+                continue
+            except Exception as err:
+                if recorder:
+                    recorder.record(op, method, url, kwargs, None, time.time() - start, err)
+                raise
+            if recorder:
+                recorder.record(op, method, url, kwargs, response, time.time() - start)
+            endpoint_set.succeeded(endpoint)
+            if controller.states.get('endpoint') != str(endpoint):
+                controller.updateStateOnServer(key='endpoint', value=str(endpoint))
+            return response
+
+        raise last_error or requests.ConnectionError(f"{controller.name}: no controller address configured")
+
     def is_unifi_os(self, device):
         """
         check for Unifi OS controller e.g. UDM, UDM Pro.
@@ -183,7 +407,7 @@ class Plugin(indigo.PluginBase):
             requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
         try:
-            r = requests.head(f'https://{device.pluginProps["address"]}:{device.pluginProps["port"]}', verify=ssl_verify, timeout=5.0)
+            r = self.controller_request(device, None, 'is_unifi_os', 'HEAD', "", allow_redirects=False, verify=ssl_verify, timeout=5.0)
         except Exception as err:
             self.logger.error(f"UniFi Controller OS Check Error: {err}")
             return False
@@ -197,36 +421,36 @@ class Plugin(indigo.PluginBase):
         self.logger.warning(f'{device.name}: Unable to determine controller type - using Unifi Standard controller')
         return False
 
-    def updateUniFiController(self, device):
+    def updateUniFiController(self, device, only_sites=None):
 
-        self.logger.debug(f"{device.name}: Updating controller")
+        self.logger.debug(f"{device.name}: Updating controller{f', sites {only_sites}' if only_sites else ''}")
+        old_sites = self.unifi_controllers[device.id].get('sites', {})
 
         headers = {"Accept": "application/json", "Content-Type": "application/json"}
         login_headers = {"Accept": "application/json", "Content-Type": "application/json", "referer": "/login"}
-        base_url = f"https://{device.pluginProps['address']}:{device.pluginProps['port']}/"
         login_body = {"username": device.pluginProps['username'], "password": device.pluginProps['password'], 'strict': True}
         ssl_verify = device.pluginProps.get('ssl_verify', False)
 
-        with requests.Session() as session:
+        with requests.Session() as session, self.capture_cycle(device, 'update'):
 
             # set up URL templates based on controller type
             unifi_os = self.is_unifi_os(device)
             if unifi_os:
-                login_url  = "{}api/auth/login"
-                status_url = "{}proxy/network/status"
-                sites_url  = "{}proxy/network/api/self/sites"
-                active_url = "{}proxy/network/api/s/{}/stat/sta"
-                device_url = "{}proxy/network/api/s/{}/stat/device"
+                login_url  = "/api/auth/login"
+                status_url = "/proxy/network/status"
+                sites_url  = "/proxy/network/api/self/sites"
+                active_url = "/proxy/network/api/s/{}/stat/sta"
+                device_url = "/proxy/network/api/s/{}/stat/device"
             else:
-                login_url  = "{}api/login"
-                status_url = "{}status"
-                sites_url  = "{}api/self/sites"
-                active_url = "{}api/s/{}/stat/sta"
-                device_url = "{}api/s/{}/stat/device"
+                login_url  = "/api/login"
+                status_url = "/status"
+                sites_url  = "/api/self/sites"
+                active_url = "/api/s/{}/stat/sta"
+                device_url = "/api/s/{}/stat/device"
 
             try:
-                url = login_url.format(base_url)
-                response = session.post(url, headers=login_headers, json=login_body, verify=ssl_verify, timeout=5.0)
+                url = login_url
+                response = self.controller_request(device, session, 'update', 'POST', url, headers=login_headers, json=login_body, verify=ssl_verify, timeout=5.0)
             except Exception as err:
                 self.logger.error(f"UniFi Controller Login Connection Error: {err}")
                 device.updateStateOnServer(key='status', value="Connection Error")
@@ -251,8 +475,8 @@ class Plugin(indigo.PluginBase):
             else:
                 cookies = {"unifises": cookies_dict.get('unifises'), "csrf_token": cookies_dict.get('csrf_token')}
 
-            url = status_url.format(base_url)
-            response = session.get(url, headers=headers, cookies=cookies, verify=ssl_verify, timeout=5.0)
+            url = status_url
+            response = self.controller_request(device, session, 'update', 'GET', url, headers=headers, cookies=cookies, verify=ssl_verify, timeout=5.0)
             if response.status_code != requests.codes.ok:
                 self.logger.error(f"UniFi Controller Status Error: {response.status_code}")
                 device.updateStateOnServer(key='status', value="Status Error")
@@ -277,8 +501,8 @@ class Plugin(indigo.PluginBase):
 
             self.logger.debug(f"{device.name}: UniFi Controller Getting Sites")
 
-            url = sites_url.format(base_url)
-            response = session.get(url, headers=headers, cookies=cookies, verify=ssl_verify, timeout=5.0)
+            url = sites_url
+            response = self.controller_request(device, session, 'update', 'GET', url, headers=headers, cookies=cookies, verify=ssl_verify, timeout=5.0)
             if not response.status_code == requests.codes.ok:
                 self.logger.error(f"UniFi Controller Get Sites Error: {response.status_code}")
                 device.updateStateOnServer(key='status', value="Sites Error")
@@ -289,14 +513,20 @@ class Plugin(indigo.PluginBase):
 
             siteList = response.json()['data']
             sites = {}
+            polled = []
             for site in siteList:
+                if only_sites and site['name'] not in only_sites and site['name'] in old_sites:
+                    sites[site['name']] = old_sites[site['name']]    # not asked for, keep what we have
+                    continue
+
                 self.logger.threaddebug(f"Saving Site {site['name']} ({site['desc']})")
-                sites[site['name']] = {'description': site['desc']}
+                sites[site['name']] = {'description': site['desc'], 'updated': self.clock()}
+                polled.append(site['name'])
 
                 # Get active Clients for site
 
-                url = active_url.format(base_url, site['name'])
-                response = session.get(url, headers=headers, cookies=cookies, verify=ssl_verify, timeout=5.0)
+                url = active_url.format(site['name'])
+                response = self.controller_request(device, session, 'update', 'GET', url, headers=headers, cookies=cookies, verify=ssl_verify, timeout=5.0)
                 if not response.status_code == requests.codes.ok:
                     self.logger.error(u"UniFi Controller Get Active Clients Error: {}".format(response.status_code))
                     device.updateStateOnServer(key='status', value="Get Client Error")
@@ -315,8 +545,8 @@ class Plugin(indigo.PluginBase):
 
                 # Get UniFi Devices for the site
 
-                url = device_url.format(base_url, site['name'])
-                response = session.get(url, headers=headers, cookies=cookies, verify=ssl_verify, timeout=5.0)
+                url = device_url.format(site['name'])
+                response = self.controller_request(device, session, 'update', 'GET', url, headers=headers, cookies=cookies, verify=ssl_verify, timeout=5.0)
                 if not response.status_code == requests.codes.ok:
                     self.logger.error(f"UniFi Controller Get Devices Error: {response.status_code}")
                 response.raise_for_status()
@@ -330,10 +560,62 @@ class Plugin(indigo.PluginBase):
                     uDevices[uDevice.get('mac')] = uDevice
                 sites[site['name']]['devices'] = uDevices
 
-            # all done, save the data
+            # all done, save the data and update the lookup indexes
 
             self.unifi_controllers[device.id]['sites'] = sites
 
+            for key in [key for key in self.client_indexes if key[0] == device.id and key[1] not in sites]:
+                del self.client_indexes[key]
+            for name in polled:
+                events = self.client_indexes.setdefault((device.id, name), SiteIndex()).update(sites[name]['actives'], self.offlineMissedPolls)
+                for event in events:
+                    self.clientEventTriggers(device, name, event)
+
+    def clientEventTriggers(self, controller, site, event):
+        event.update({'controller': controller.id, 'site': site, 'time': self.clock()})
+        self.logger.debug(f"{controller.name}: {event['event']} for {event['name']}: {event['old_ap_mac']} -> {event['new_ap_mac']}")
+
+        # Indigo can't handle None values, and trigger actions have no way to get the event, so save it for them
+
+        payload = {key: ('' if value is None else value) for key, value in event.items()}
+        self.last_client_events[event['mac']] = payload
+        self.last_client_event = payload
+        indigo.server.broadcastToSubscribers("clientEvent", payload)
+
+        for trigger in list(self.triggers.values()):
+            if trigger.pluginTypeId != event['event']:
+                continue
+            mac = trigger.pluginProps.get('address', '').strip().lower()
+            if mac and mac != event['mac']:
+                continue
+            self.logger.debug(f"{trigger.name}: Executing trigger")
+            indigo.trigger.execute(trigger)
+
+    def confirm_offline(self, device, controllerID, site):
+        # hysteresis, so one missed poll doesn't flap onOffState.  Only counts polls that actually happened.
+        if not device.states.get('onOffState', False):
+            return True
+        try:
+            updated = self.unifi_controllers[controllerID]['sites'][site]['updated']
+        except (Exception,):
+            updated = None
+        count, last_updated = self.missed_polls.get(device.id, (0, None))
+        if updated is None or updated != last_updated:
+            count += 1
+        self.missed_polls[device.id] = (count, updated)
+        return count >= self.offlineMissedPolls
+
+    def publish_states(self, device, states):
+        # only send the states that changed enough to matter, see deadband.py
+        publish = self.deadband.filter(device.id, device.deviceTypeId, states, self.clock())
+        self.logger.threaddebug(f"{device.name}: publishing {len(publish)} of {len(states)} states")
+        if not publish:
+            return
+        try:
+            device.updateStatesOnServer(publish)
+        except TypeError as err:
+            self.logger.error(f"{device.name}: invalid state type in states_list: {publish}")
+
     def updateUniFiClient(self, device):
 
         self.logger.threaddebug(f"{device.name}: Updating UniFi Client: {device.address}")
@@ -357,33 +639,40 @@ class Plugin(indigo.PluginBase):
             if client_data:
                 dict_to_states("", client_data, states_list)
 
-            self.unifi_clients[device.id] = states_list
-            device.stateListOrDisplayStateIdChanged()
-
-            try:
-                device.updateStatesOnServer(states_list)
-            except TypeError as err:
-                self.logger.error(f"{device.name}: invalid state type in states_list: {states_list}")
+            # only rebuild the device's state list if the keys or their types changed
+            states = CompactStates(states_list)
+            previous = self.unifi_clients.get(device.id)
+            self.unifi_clients[device.id] = states
+            if not states.same_shape(previous):
+                device.stateListOrDisplayStateIdChanged()
+            self.publish_states(device, states)
 
         if device.deviceTypeId == "unifiClient":
-            if offline:
+            if offline and not self.confirm_offline(device, controller, site):
+                self.logger.debug(f"{device.name}: Missing, waiting for another poll before going offline")
+
+            elif offline:
                 self.logger.debug(u"{}: Offline".format(device.name))
                 device.updateStateOnServer(key="onOffState", value=False, uiValue=u"Offline")
                 device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
 
             else:
+                self.missed_polls.pop(device.id, None)
                 self.logger.debug(u"{}: Online".format(device.name))
                 device.updateStateOnServer(key="onOffState", value=True, uiValue=u"Online")
                 device.updateStateImageOnServer(indigo.kStateImageSel.SensorOn)
 
         elif device.deviceTypeId == "unifiWirelessClient":
             essid = client_data.get('essid', None)
-            if offline or not essid:
+            if (offline or not essid) and not self.confirm_offline(device, controller, site):
+                self.logger.debug(f"{device.name}: Missing, waiting for another poll before going offline")
+
+            elif offline or not essid:
                 device.updateStateOnServer(key="onOffState", value=False, uiValue=u"Offline")
                 device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
-                last_seen = device.states.get('last_seen', None)
+                last_seen = self.deadband.latest.get(device.id, {}).get('last_seen') or device.states.get('last_seen', None)
                 if last_seen:
-                    offline_seconds = int((datetime.now() - datetime.fromtimestamp(last_seen)).total_seconds())
+                    offline_seconds = int((datetime.fromtimestamp(self.clock()) - datetime.fromtimestamp(last_seen)).total_seconds())
                     minutes, seconds = divmod(offline_seconds, 60)
                     hours, minutes = divmod(minutes, 60)
                     status = f"Offline {int(hours):02}:{int(minutes):02}:{int(seconds):02}"
@@ -396,6 +685,7 @@ class Plugin(indigo.PluginBase):
                 self.logger.debug(f"{device.name}: {status} for {offline_seconds} seconds")
 
             else:
+                self.missed_polls.pop(device.id, None)
                 self.logger.debug(f"{device.name}: Online @ {essid}")
                 device.updateStateOnServer(key="onOffState", value=True, uiValue=u"Online @ {}".format(essid))
                 device.updateStateOnServer(key='offline_seconds', value=0)
@@ -435,22 +725,26 @@ class Plugin(indigo.PluginBase):
             if device_data:
                 dict_to_states(u"", device_data, states_list)
 
-            self.unifi_devices[device.id] = states_list
-            device.stateListOrDisplayStateIdChanged()
-            try:
-                device.updateStatesOnServer(states_list)
-            except TypeError as err:
-                self.logger.error(f"{device.name}: invalid state type in states_list: {states_list}")
+            states = CompactStates(states_list)
+            previous = self.unifi_devices.get(device.id)
+            self.unifi_devices[device.id] = states
+            if not states.same_shape(previous):
+                device.stateListOrDisplayStateIdChanged()
+            self.publish_states(device, states)
 
         if device.deviceTypeId == "unifiDevice":
 
             uptime = device_data.get('_uptime', None)
-            if offline or not uptime:
+            if (offline or not uptime) and not self.confirm_offline(device, controller, site):
+                self.logger.debug(f"{device.name}: Missing, waiting for another poll before going offline")
+
+            elif offline or not uptime:
                 self.logger.debug(f"{device.name}: Offline")
                 device.updateStateOnServer(key="onOffState", value=False, uiValue=u"Offline")
                 device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
 
             else:
+                self.missed_polls.pop(device.id, None)
                 minutes, seconds = divmod(uptime, 60)
                 hours, minutes = divmod(minutes, 60)
                 days, hours = divmod(hours, 24)
@@ -463,12 +757,16 @@ class Plugin(indigo.PluginBase):
             status_display = device.pluginProps.get('status_display', 'uptime')
 
             uptime = device_data.get('_uptime', None)
-            if offline or not uptime:
+            if (offline or not uptime) and not self.confirm_offline(device, controller, site):
+                self.logger.debug(f"{device.name}: Missing, waiting for another poll before going offline")
+
+            elif offline or not uptime:
                 self.logger.debug(f"{device.name}: Offline")
                 device.updateStateOnServer(key="onOffState", value=False, uiValue=u"Offline")
                 device.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
 
             elif status_display == 'uptime':
+                self.missed_polls.pop(device.id, None)
                 minutes, seconds = divmod(uptime, 60)
                 hours, minutes = divmod(minutes, 60)
                 days, hours = divmod(hours, 24)
@@ -478,6 +776,7 @@ class Plugin(indigo.PluginBase):
                 device.updateStateImageOnServer(indigo.kStateImageSel.SensorOn)
 
             elif status_display == 'wifi':
+                self.missed_polls.pop(device.id, None)
                 status = "Wifi: "
                 first = True
                 for radio in device_data["radio_table_stats"]:
@@ -496,6 +795,21 @@ class Plugin(indigo.PluginBase):
         else:
             self.logger.error(f"{device.name}: deviceTypeId: {device.deviceTypeId}")
 
+    ########################################
+    #
+    # Trigger (Event) methods
+    #
+    ########################################
+
+    def triggerStartProcessing(self, trigger):
+        self.logger.debug(f"{trigger.name}: Adding Trigger")
+        self.triggers[trigger.id] = trigger
+
+    def triggerStopProcessing(self, trigger):
+        self.logger.debug(f"{trigger.name}: Removing Trigger")
+        if trigger.id in self.triggers:
+            del self.triggers[trigger.id]
+
     ################################################################################
     #
     # callback for state list changes, called from stateListOrDisplayStateIdChanged()
@@ -508,9 +822,9 @@ class Plugin(indigo.PluginBase):
 
         if device.id in self.unifi_clients and self.unifi_clients[device.id]:
 
-            for item in self.unifi_clients[device.id]:
-                key = item['key']
-                value = item['value']
+            for key, value in self.unifi_clients[device.id]:
+                if self.deadband.never(device.deviceTypeId, key):
+                    continue
                 if isinstance(value, bool):
                     dynamic_state = self.getDeviceStateDictForBoolTrueFalseType(str(key), str(key), str(key))
                     self.logger.threaddebug(f"{device.name}: getDeviceStateList, adding Bool state {key}, value {value}")
@@ -528,9 +842,9 @@ class Plugin(indigo.PluginBase):
 
         elif device.id in self.unifi_devices and self.unifi_devices[device.id]:
 
-            for item in self.unifi_devices[device.id]:
-                key = item['key']
-                value = item['value']
+            for key, value in self.unifi_devices[device.id]:
+                if self.deadband.never(device.deviceTypeId, key):
+                    continue
                 if isinstance(value, bool):
                     dynamic_state = self.getDeviceStateDictForBoolTrueFalseType(str(key), str(key), str(key))
                     self.logger.threaddebug(f"{device.name}: getDeviceStateList, adding Bool state {key}, value {value}")
@@ -727,10 +1041,18 @@ class Plugin(indigo.PluginBase):
     def validatePrefsConfigUi(self, valuesDict):
         self.logger.debug(f"validatePrefsConfigUi: valuesDict = {valuesDict}")
 
-        # possible to do real validation and return an error if it fails, such as:      
-        # errorMsgDict = indigo.Dict()
-        # errorMsgDict[u"requiredFieldChk"] = u"You must check this box to continue"
-        # return (False, valuesDict, errorMsgDict)
+        errorMsgDict = indigo.Dict()
+        try:
+            deadband_rules(valuesDict.get('deadbandOverrides', ""))
+        except ValueError as err:
+            errorMsgDict['deadbandOverrides'] = f"Deadband overrides {err}"
+        try:
+            if int(valuesDict.get('offlineMissedPolls', "2")) < 1:
+                raise ValueError
+        except ValueError:
+            errorMsgDict['offlineMissedPolls'] = "Must be a whole number, 1 or more"
+        if len(errorMsgDict):
+            return False, valuesDict, errorMsgDict
 
         # if no errors, return True and the values as a tuple
         return True, valuesDict
@@ -752,6 +1074,16 @@ class Plugin(indigo.PluginBase):
             except (Exception,):
                 self.updateFrequency = 60.0
 
+            self.offlineMissedPolls = int(valuesDict.get('offlineMissedPolls', "2"))
+            self.deadband = DeadbandFilter(deadband_rules(valuesDict.get('deadbandOverrides', "")), valuesDict.get('deadbandEnabled', True))
+
+            # the rules decide which states the devices have
+            for devID in list(self.unifi_clients) + list(self.unifi_devices):
+                try:
+                    indigo.devices[devID].stateListOrDisplayStateIdChanged()
+                except Exception as err:
+                    self.logger.error(f"Error retrieving Device ID {devID}: {err}")
+
     # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
     # Plugin Menu routines
     # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
@@ -777,6 +1109,42 @@ class Plugin(indigo.PluginBase):
         params = {'cmd': "power-cycle", 'mac':device.address, 'port_idx': int(plugin_action.props['port'])}
         self.command_unifi_controller(device, params)
 
+    def find_clients_action(self, plugin_action, device, callerWaitingForResult):
+        self.logger.debug(f"find_clients_action, props = {plugin_action.props}")
+        index = plugin_action.props.get('index', 'mac')
+        value = plugin_action.props.get('value', '')
+        controller = str(plugin_action.props.get('unifi_controller', '')).strip()
+        site = plugin_action.props.get('unifi_site', '')
+
+        try:
+            controller = int(controller) if controller else None
+        except ValueError:
+            self.logger.error(f"find_clients_action: invalid controller ID: {controller}")
+            return []
+
+        results = []
+        for (controllerID, site_name), site_index in list(self.client_indexes.items()):
+            if controller is not None and controller != controllerID:
+                continue
+            if site and site != site_name:
+                continue
+            try:
+                found = site_index.find(index, value)
+            except ValueError as err:
+                self.logger.error(f"find_clients_action: {err}")
+                return []
+            results.extend(summaryFromClient(controllerID, site_name, data) for data in found)
+
+        self.logger.debug(f"find_clients_action: {index} = {value} found {len(results)} clients")
+        return results
+
+    def last_client_event_action(self, plugin_action, device, callerWaitingForResult):
+        self.logger.debug(f"last_client_event_action, props = {plugin_action.props}")
+        mac = plugin_action.props.get('address', '').strip().lower()
+        if mac:
+            return self.last_client_events.get(mac, {})
+        return self.last_client_event or {}
+
     def command_unifi_controller(self, device, params):
 
         self.logger.debug(f"{device.name}: Sending command to controller with params: {params}")
@@ -788,21 +1156,20 @@ class Plugin(indigo.PluginBase):
         ssl_verify = device.pluginProps.get('ssl_verify', False)
         site = device.pluginProps['unifi_site']
 
-        with requests.Session() as session:
+        with requests.Session() as session, self.capture_cycle(unifi_controller, 'command'):
 
             # set up URL templates based on controller type
             unifi_os = self.is_unifi_os(unifi_controller)
             if unifi_os:
-                base_url = f"https://{unifi_controller.pluginProps['address']}"
-                login_url  = f"{base_url}/api/auth/login"
-                cmd_url    = "{}/proxy/network/api/s/{}/cmd/devmgr"
+                login_url  = "/api/auth/login"
+                cmd_url    = "/proxy/network/api/s/{}/cmd/devmgr"
             else:
-                base_url = f"https://{unifi_controller.pluginProps['address']}:{unifi_controller.pluginProps['port']}"
-                login_url  = f"{base_url}/api/login"
-                cmd_url    = "{}/api/s/{}/cmd/devmgr"
+                login_url  = "/api/login"
+                cmd_url    = "/api/s/{}/cmd/devmgr"
 
             try:
-                response = session.post(login_url, headers=login_headers, json=login_params, verify=ssl_verify, timeout=5.0)
+                response = self.controller_request(unifi_controller, session, 'command', 'POST', login_url, with_port=not unifi_os,
+                                                   headers=login_headers, json=login_params, verify=ssl_verify, timeout=5.0)
             except Exception as err:
                 self.logger.error(f"UniFi Controller Login Connection Error: {err}")
                 unifi_controller.updateStateOnServer(key='status', value="Connection Error")
@@ -830,13 +1197,14 @@ class Plugin(indigo.PluginBase):
             else:
                 cookies = {"unifises": cookies_dict.get('unifises'), "csrf_token": cookies_dict.get('csrf_token')}
 
-            url = cmd_url.format(base_url, site)
+            url = cmd_url.format(site)
             self.logger.threaddebug(f"{device.name}: Post cmd url: {url}")
             self.logger.threaddebug(f"{device.name}: Post cmd headers: {headers}")
             self.logger.threaddebug(f"{device.name}: Post cmd cookies: {cookies}")
             self.logger.threaddebug(f"{device.name}: Post cmd params: {params}")
             try:
-                response = session.post(url, headers=headers, cookies=cookies, json=params, verify=ssl_verify, timeout=5.0)
+                response = self.controller_request(unifi_controller, session, 'command', 'POST', url, with_port=not unifi_os, idempotent=False,
+                                                   headers=headers, cookies=cookies, json=params, verify=ssl_verify, timeout=5.0)
             except Exception as err:
                 self.logger.error(f"UniFi Controller Post Error: {err}")
                 unifi_controller.updateStateOnServer(key='status', value="Post Error")
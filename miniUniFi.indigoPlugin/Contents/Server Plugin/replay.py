@@ -0,0 +1,301 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+#
+# Replays a traffic capture (see traffic_capture.py) through the plugin, outside of Indigo.
+#
+#   python3 replay.py capture-12345.jsonl.gz [--save-baseline base.json] [--baseline base.json] [--tolerance 1.5]
+#
+# A minimal stand-in for the Indigo host is installed before plugin.py is imported.  Each recorded controller
+# update is replayed, then every client and UniFi device seen in the capture is updated from the result.  The
+# resulting device states and the time taken for each cycle can be saved as a baseline, and compared against it
+# on later runs.  Exits with status 1 if the states differ or the timings have regressed.  The plugin's clock is
+# set to the recorded start time of each cycle, so deadbands and offline timing behave as they did live.
+#
+####################
+
+import sys
+import json
+import time
+import types
+import hashlib
+import logging
+import argparse
+import builtins
+
+import requests
+
+from traffic_capture import read_archive
+
+########################################
+# Indigo host stand-in
+########################################
+
+logging.addLevelName(5, "THREADDEBUG")
+logging.Logger.threaddebug = lambda self, msg, *args, **kwargs: self.log(5, msg, *args, **kwargs)
+
+
+class StubDevice(object):
+
+    def __init__(self, dev_id, name, deviceTypeId, pluginProps, address=""):
+        self.id = dev_id
+        self.name = name
+        self.deviceTypeId = deviceTypeId
+        self.pluginProps = dict(pluginProps)
+        self.sharedProps = {}
+        self.address = address
+        self.model = ""
+        self.subModel = ""
+        self.states = {}
+        self.plugin = None
+
+    def updateStateOnServer(self, key, value, uiValue=None, **kwargs):
+        self.states[key] = value
+
+    def updateStatesOnServer(self, states_list):
+        for item in states_list:
+            self.states[item['key']] = item['value']
+
+    def updateStateImageOnServer(self, image):
+        pass
+
+    def replacePluginPropsOnServer(self, props):
+        self.pluginProps = dict(props)
+
+    def replaceSharedPropsOnServer(self, props):
+        self.sharedProps = dict(props)
+
+    def replaceOnServer(self):
+        pass
+
+    def stateListOrDisplayStateIdChanged(self):
+        if self.plugin:
+            self.plugin.getDeviceStateList(self)
+
+
+class StubPluginBase(object):
+
+    class StopThread(Exception):
+        pass
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId = pluginId
+        self.pluginPrefs = pluginPrefs
+        self.logger = logging.getLogger("Plugin")
+        self.plugin_file_handler = logging.NullHandler()
+        self.indigo_log_handler = logging.NullHandler()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def getDeviceStateList(self, device):
+        return []
+
+    def getDeviceStateDictForBoolTrueFalseType(self, key, trigger_label, control_label):
+        return {'Key': key, 'Type': 'bool'}
+
+    def getDeviceStateDictForNumberType(self, key, trigger_label, control_label):
+        return {'Key': key, 'Type': 'number'}
+
+    def getDeviceStateDictForStringType(self, key, trigger_label, control_label):
+        return {'Key': key, 'Type': 'string'}
+
+
+def install_stub_host():
+    indigo = types.ModuleType("indigo")
+    indigo.PluginBase = StubPluginBase
+    indigo.Dict = dict
+    indigo.List = list
+    indigo.devices = {}
+    indigo.trigger = types.SimpleNamespace(execute=lambda trigger: None)
+    indigo.kStateImageSel = types.SimpleNamespace(SensorOn="SensorOn", SensorOff="SensorOff", SensorTripped="SensorTripped")
+    indigo.server = types.SimpleNamespace(getInstallFolderPath=lambda: ".", broadcastToSubscribers=lambda *args: None)
+    builtins.indigo = indigo
+    sys.modules['indigo'] = indigo
+    return indigo
+
+########################################
+# Replayed traffic
+########################################
+
+class ReplayResponse(object):
+
+    def __init__(self, entry):
+        self.status_code = entry.get('status', 0)
+        self.text = entry.get('body', "")
+        self.headers = entry.get('headers') or {}
+        self.cookies = requests.cookies.RequestsCookieJar()
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} (replayed)")
+
+
+def replay_plugin_class(plugin_module):
+
+    class ReplayPlugin(plugin_module.Plugin):
+
+        def __init__(self, *args):
+            super().__init__(*args)
+            self.pending = []
+
+        def controller_request(self, controller, session, op, method, path, with_port=True, **kwargs):
+            # a failed address is recorded as an error followed by the same request to the next address,
+            # so errors only count if none of those retries succeeded
+            path = path or '/'
+            for i, entry in enumerate(self.pending):
+                if entry['method'] == method and entry['path'] == path:
+                    while 'error' in entry and i + 1 < len(self.pending) and \
+                            self.pending[i + 1]['method'] == method and self.pending[i + 1]['path'] == path:
+                        i += 1
+                        entry = self.pending[i]
+                    del self.pending[:i + 1]
+                    if 'error' in entry:
+                        raise requests.ConnectionError(entry['error'])
+                    return ReplayResponse(entry)
+            raise requests.ConnectionError(f"no recorded response for {method} {path}")
+
+    return ReplayPlugin
+
+########################################
+# Driver
+########################################
+
+def group_cycles(entries):
+    cycles = {}
+    order = []
+    for entry in entries:
+        cycle = entry.get('cycle')
+        if cycle is None:
+            continue
+        if cycle not in cycles:
+            cycles[cycle] = {'op': None, 'requests': [], 'recorded': None, 't': None}
+            order.append(cycle)
+        if entry['event'] == 'begin':
+            cycles[cycle]['op'] = entry['op']
+            cycles[cycle]['t'] = entry.get('t')
+        elif entry['event'] == 'end':
+            cycles[cycle]['recorded'] = entry['elapsed']
+        else:
+            cycles[cycle]['requests'].append(entry)
+    return [cycles[cycle] for cycle in order if cycles[cycle]['op']]
+
+
+def snapshot(indigo):
+    return {
+        dev.name: dict(sorted(dev.states.items()))
+        for dev in sorted(indigo.devices.values(), key=lambda d: d.id)
+    }
+
+
+def replay(archive):
+    indigo = install_stub_host()
+    import plugin as plugin_module
+
+    plugin = replay_plugin_class(plugin_module)("com.flyingdiver.indigoplugin.miniUniFi", "miniUniFi", "replay", {'logLevel': logging.WARNING})
+    controller = StubDevice(1, "Controller", 'unifiController', {'address': "replay", 'port': "443", 'username': "", 'password': ""})
+    controller.plugin = plugin
+    indigo.devices[controller.id] = controller
+    plugin.deviceStartComm(controller)
+
+    results = []
+    for cycle in group_cycles(read_archive(archive)):
+        plugin.pending = list(cycle['requests'])
+        cycle_time = cycle['t'] if cycle['t'] is not None else time.time()
+        plugin.clock = lambda: cycle_time
+        start = time.perf_counter()
+
+        if cycle['op'] == 'update':
+            plugin.updateUniFiController(controller)
+            add_discovered_devices(plugin, indigo, controller)
+            for clientID in list(plugin.unifi_clients):
+                plugin.updateUniFiClient(indigo.devices[clientID])
+            for deviceID in list(plugin.unifi_devices):
+                plugin.updateUniFiDevice(indigo.devices[deviceID])
+
+        elif cycle['op'] == 'command':
+            params = next((entry['json'] for entry in cycle['requests'] if entry['path'].endswith("/cmd/devmgr")), None)
+            if params:
+                target = StubDevice(0, "Command Target", 'unifiDevice', {'unifi_controller': str(controller.id), 'unifi_site': 'default'}, params.get('mac', ""))
+                plugin.command_unifi_controller(target, params)
+
+        elapsed = time.perf_counter() - start
+        states = snapshot(indigo)
+        digest = hashlib.sha1(json.dumps(states, sort_keys=True, default=str).encode()).hexdigest()
+        results.append({'op': cycle['op'], 'elapsed': elapsed, 'recorded': cycle['recorded'], 'digest': digest})
+
+    return {'cycles': results, 'states': snapshot(indigo)}
+
+
+def add_discovered_devices(plugin, indigo, controller):
+    known = {(dev.pluginProps.get('unifi_site'), dev.address) for dev in indigo.devices.values()}
+    for site_name, site in plugin.unifi_controllers[controller.id].get('sites', {}).items():
+        for mac, data in site['actives'].items():
+            if (site_name, mac) not in known:
+                typeId = 'unifiClient' if data.get('is_wired') else 'unifiWirelessClient'
+                add_device(plugin, indigo, controller, typeId, site_name, mac)
+        for mac, data in site['devices'].items():
+            if (site_name, mac) not in known:
+                typeId = 'unifiAccessPoint' if data.get('type') == 'uap' else 'unifiDevice'
+                add_device(plugin, indigo, controller, typeId, site_name, mac)
+
+
+def add_device(plugin, indigo, controller, typeId, site, mac):
+    dev = StubDevice(len(indigo.devices) + 1, f"{site}/{mac}", typeId, {'unifi_controller': str(controller.id), 'unifi_site': site, 'address': mac}, mac)
+    dev.plugin = plugin
+    indigo.devices[dev.id] = dev
+    plugin.deviceStartComm(dev)
+
+
+def compare(result, baseline, tolerance):
+    problems = []
+    if len(result['cycles']) != len(baseline['cycles']):
+        problems.append(f"cycle count {len(result['cycles'])} != baseline {len(baseline['cycles'])}")
+    for i, (cycle, base) in enumerate(zip(result['cycles'], baseline['cycles'])):
+        if cycle['digest'] != base['digest']:
+            problems.append(f"cycle {i} ({cycle['op']}): device states differ from baseline")
+    total = sum(cycle['elapsed'] for cycle in result['cycles'])
+    base_total = sum(cycle['elapsed'] for cycle in baseline['cycles'])
+    if base_total and total > base_total * tolerance:
+        problems.append(f"replay took {total:.3f}s, baseline {base_total:.3f}s (tolerance {tolerance}x)")
+    states = json.loads(json.dumps(result['states'], default=str))
+    for name in sorted(set(states) | set(baseline['states'])):
+        if states.get(name) != baseline['states'].get(name):
+            problems.append(f"final states differ for {name}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured UniFi controller traffic through the plugin")
+    parser.add_argument("archive", help="capture file (rotated files alongside it are included)")
+    parser.add_argument("--baseline", help="compare against this baseline")
+    parser.add_argument("--save-baseline", help="save the results as a baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown vs. baseline (default 1.5x)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    result = replay(args.archive)
+
+    for i, cycle in enumerate(result['cycles']):
+        recorded = f"{cycle['recorded']:.3f}s" if cycle['recorded'] is not None else "?"
+        print(f"cycle {i:4d} {cycle['op']:8s} replay {cycle['elapsed']:.3f}s  recorded {recorded}  {cycle['digest'][:12]}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True, default=str)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION: {problem}")
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
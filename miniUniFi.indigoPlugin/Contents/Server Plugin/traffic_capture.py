@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import os
+import re
+import gzip
+import json
+import time
+import zlib
+import threading
+
+from urllib.parse import urlsplit
+
+# Records controller requests and responses to rotating, gzip compressed JSON lines files, for later use by replay.py.
+# Anything that looks like a credential is scrubbed before it's written, and only the URL path is kept (not the host).
+
+SCRUBBED = "***"
+SECRET_WORDS = {'token', 'password', 'passwd', 'secret', 'passphrase', 'username', 'cookie', 'csrf', 'authorization',
+                'unifises'}        # anywhere in the key, as a whole "_" or "-" separated part
+SECRET_LAST_WORDS = {'key'}        # api_key, ssh_key, but not key_mgmt
+SECRET_PREFIXES = ('x_', 'sso_')
+SECRET_KEYS = {'email', 'first_name', 'last_name', 'full_name', 'apikey'}
+
+def is_secret(key):
+    key = re.sub(r"([a-z0-9])([A-Z])", r"\1_\2", str(key)).lower()       # apiKey -> api_key
+    parts = re.split(r"[_-]", key)
+    return key.startswith(SECRET_PREFIXES) or key in SECRET_KEYS or parts[-1] in SECRET_LAST_WORDS or \
+        any(part in SECRET_WORDS for part in parts)
+
+def scrub(obj):
+    if isinstance(obj, dict):
+        return {key: SCRUBBED if is_secret(key) else scrub(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [scrub(item) for item in obj]
+    return obj
+
+def scrub_text(text):
+    try:
+        return json.dumps(scrub(json.loads(text)))
+    except (Exception,):
+        return text
+
+def archive_files(path):
+    # oldest first: capture.jsonl.gz.N ... capture.jsonl.gz.1, capture.jsonl.gz
+    folder, name = os.path.split(path)
+    rotated = sorted(
+        (int(f[len(name) + 1:]) for f in os.listdir(folder or '.') if f.startswith(f"{name}.") and f[len(name) + 1:].isdigit()),
+        reverse=True)
+    files = [f"{path}.{n}" for n in rotated]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+def read_archive(path):
+    entries = []
+    for filename in archive_files(path):
+        for line in read_gzip_lines(filename):
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                pass
+    return entries
+
+def read_gzip_lines(filename):
+    # decompress member by member, so a file that wasn't closed properly (plugin killed or crashed)
+    # still gives every complete line up to the damage
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return []
+    chunks = []
+    decompressor = zlib.decompressobj(wbits=31)
+    pos = 0
+    try:
+        while pos < len(data):
+            chunk = data[pos:pos + 4096]
+            chunks.append(decompressor.decompress(chunk))
+            pos += len(chunk)
+            if decompressor.eof:    # the next member starts in the unused part of the last chunk
+                pos -= len(decompressor.unused_data)
+                decompressor = zlib.decompressobj(wbits=31)
+    except zlib.error:
+        pass
+    lines = b"".join(chunks).decode('utf-8', errors='replace').split("\n")
+    return [line for line in lines[:-1] if line.strip()]      # the last piece is incomplete (or empty)
+
+
+class TrafficRecorder(object):
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.next_cycle = 1
+        self.written = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # always start a new file, the last one may not have been closed properly
+        if os.path.exists(path) and os.path.getsize(path):
+            self._rotate_files()
+        self.file = gzip.open(path, 'wt')
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def begin_cycle(self, op, controller):
+        with self.lock:
+            self.local.cycle = self.next_cycle
+            self.next_cycle += 1
+        self.local.start = time.time()
+        self._write({'event': 'begin', 'cycle': self.local.cycle, 'op': op, 'controller': controller, 't': self.local.start})
+
+    def end_cycle(self):
+        cycle = getattr(self.local, 'cycle', None)
+        if cycle is None:
+            return
+        self._write({'event': 'end', 'cycle': cycle, 'elapsed': time.time() - self.local.start})
+        self.local.cycle = None
+        with self.lock:
+            if self.file:
+                self.file.flush()
+
+    def record(self, op, method, url, kwargs, response, elapsed, error=None):
+        path = urlsplit(url).path or '/'
+        entry = {
+            'event': 'request',
+            'cycle': getattr(self.local, 'cycle', None),
+            'op': op,
+            'method': method,
+            'path': path,
+            'json': scrub(kwargs.get('json')),
+            'elapsed': elapsed,
+        }
+        if error is not None:
+            entry['error'] = str(error)
+        else:
+            entry['status'] = response.status_code
+            entry['headers'] = scrub(dict(response.headers))
+            # login responses are account details and tokens, nothing the plugin uses
+            entry['body'] = SCRUBBED if path.endswith('/login') else scrub_text(response.text)
+        self._write(entry)
+
+    def _write(self, entry):
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            if not self.file:
+                return
+            self.file.write(line)
+            self.written += len(line)
+            if self.written > self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        self.file.close()
+        self._rotate_files()
+        self.file = gzip.open(self.path, 'wt')
+        self.written = 0
+
+    def _rotate_files(self):
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        os.replace(self.path, f"{self.path}.1")
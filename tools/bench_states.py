@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+#
+# Compares the memory used by the flattened device states, stored as lists of {'key': ..., 'value': ...} dicts
+# and as CompactStates, for a number of simulated clients and UniFi devices.  The CompactStates figure includes
+# the deadband filter's per-device caches, which the plugin keeps alongside them.
+#
+#   python3 tools/bench_states.py [--devices 1000]
+#
+####################
+
+import os
+import sys
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "miniUniFi.indigoPlugin", "Contents", "Server Plugin"))
+
+from replay import install_stub_host                # noqa
+
+install_stub_host()
+from plugin import dict_to_states                   # noqa
+from compact_states import CompactStates            # noqa
+from deadband import DeadbandFilter, deadband_rules  # noqa
+
+
+def simulated_client(n):
+    return {
+        'mac': f"aa:bb:cc:{n >> 16 & 255:02x}:{n >> 8 & 255:02x}:{n & 255:02x}",
+        'hostname': f"client-{n}",
+        'ip': f"10.0.{n >> 8 & 255}.{n & 255}",
+        'is_wired': False,
+        'essid': "home",
+        'ap_mac': "f0:9f:c2:00:00:01",
+        'channel': 36 if n % 2 else 6,
+        'radio': "na" if n % 2 else "ng",
+        'radio_proto': "ax",
+        'signal': -40 - n % 30,
+        'rssi': 60 - n % 30,
+        'noise': -95,
+        'satisfaction': 90 + n % 10,
+        'tx_rate': 866000,
+        'rx_rate': 780000,
+        'tx_bytes': 1000000 + n,
+        'rx_bytes': 2000000 + n,
+        'tx_packets': 10000 + n,
+        'rx_packets': 20000 + n,
+        'uptime': 3600 + n,
+        'last_seen': 1700000000 + n,
+        'oui': "Apple",
+        'network': "LAN",
+        'vlan': 10,
+    }
+
+def simulated_device(n):
+    return {
+        'mac': f"f0:9f:c2:{n >> 16 & 255:02x}:{n >> 8 & 255:02x}:{n & 255:02x}",
+        'name': f"AP {n}",
+        'model': "U6LR",
+        'type': "uap",
+        'version': "6.5.54",
+        '_uptime': 86400 + n,
+        'system-stats': {'cpu': "5.0", 'mem': "40.1", 'uptime': str(86400 + n)},
+        'sys_stats': {'loadavg_1': "0.1", 'loadavg_5': "0.2", 'loadavg_15': "0.3", 'mem_total': 1000000, 'mem_used': 400000},
+        'radio_table_stats': [
+            {'name': "wifi0", 'channel': 6, 'radio': "ng", 'user-num_sta': n % 20, 'tx_power': 20, 'satisfaction': 98},
+            {'name': "wifi1", 'channel': 36, 'radio': "na", 'user-num_sta': n % 30, 'tx_power': 23, 'satisfaction': 96},
+        ],
+        'uplink': {'tx_bytes': 123456789 + n, 'rx_bytes': 987654321 + n, 'speed': 1000, 'full_duplex': True},
+    }
+
+def simulated_states(count):
+    # 90% clients, 10% UniFi devices
+    for n in range(count):
+        typeId = 'unifiAccessPoint' if n % 10 == 0 else 'unifiWirelessClient'
+        data = simulated_device(n) if n % 10 == 0 else simulated_client(n)
+        states_list = []
+        dict_to_states("", data, states_list)
+        yield typeId, states_list
+
+def measure(count, compact):
+    tracemalloc.start()
+    stored = {}
+    deadband = DeadbandFilter(deadband_rules(""))
+    for n, (typeId, states_list) in enumerate(simulated_states(count)):
+        if compact:
+            stored[n] = CompactStates(states_list)
+            deadband.filter(n, typeId, stored[n], 0.0)
+        else:
+            stored[n] = states_list
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare memory used by device state storage")
+    parser.add_argument("--devices", type=int, default=1000)
+    args = parser.parse_args()
+
+    as_lists = measure(args.devices, compact=False)
+    as_compact = measure(args.devices, compact=True)
+    print(f"{args.devices} devices")
+    print(f"  list of dicts:             {as_lists / 1024:10.1f} KiB")
+    print(f"  CompactStates + deadband:  {as_compact / 1024:10.1f} KiB  ({100.0 * as_compact / as_lists:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()